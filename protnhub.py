@@ -1,19 +1,90 @@
+import hashlib
+import heapq
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import itemgetter
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import networkx as nx
+import numpy as np
+import orjson
 import plotly.graph_objects as go
+import plotly.io as pio
 import kaleido  # Ensure kaleido is installed (pip install kaleido)
-import openai
+from openai import OpenAI
+
+try:
+    from fa2 import ForceAtlas2  # Optional: Barnes-Hut layout (pip install fa2)
+except ImportError:
+    ForceAtlas2 = None
 
 # ------------- Configuration -------------
 st.set_page_config(page_title="ProtHub", layout="wide")
-openai.api_key = st.secrets["openai"]["api_key"]
+
+@st.cache_resource
+def get_openai_client():
+    return OpenAI(api_key=st.secrets["openai"]["api_key"])
+
+_client = get_openai_client()
+
+# Configure the shared Kaleido scope once so PNG exports reuse the same renderer
+_kaleido_scope = getattr(pio.kaleido, "scope", None)
+if _kaleido_scope is not None:
+    _kaleido_scope.mathjax = None
+    _kaleido_scope.default_format = "png"
+    _kaleido_scope.default_width = 1000
+    _kaleido_scope.default_height = 800
 
 # ------------- Constants -----------------
 STRING_API_URL = "https://string-db.org/api"
 STRING_OUTPUT_FORMAT = "json"
 STRING_METHOD = "network"
 UNIPROT_SEARCH_URL = "https://rest.uniprot.org/uniprotkb/search"
+STRING_MAX_IDENTIFIERS = 2000  # Identifiers sent per STRING request
+CACHE_TTL = 3600  # Seconds to keep API responses in memory
+SUMMARY_CACHE_ENTRIES = 128  # Finished LLM summaries kept in memory
+
+# Shared HTTP session so connections are reused across API calls and reruns
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+_session = get_session()
+
+# Separate worker pools so CPU-bound layouts never queue ahead of STRING requests
+@st.cache_resource
+def get_fetch_pool():
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_layout_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+_fetch_pool = get_fetch_pool()
+_layout_pool = get_layout_pool()
+
+# ForceAtlas2 layout engine, used instead of spring_layout when available
+LAYOUT_ITERATIONS = 200
+LARGE_NETWORK_NODES = 500  # Above this, only the 2-core gets a force layout
+LARGE_NETWORK_ITERATIONS = 150
+_fa2 = ForceAtlas2(
+    outboundAttractionDistribution=True,  # Keep hubs from collapsing together
+    barnesHutOptimize=True,
+    barnesHutTheta=1.2,
+    scalingRatio=2.0,
+    gravity=1.0,
+    verbose=False,
+) if ForceAtlas2 is not None else None
 
 # ------------- Helper Functions -----------------
 def map_sequence_to_uniprot(input_text):
@@ -21,77 +92,139 @@ def map_sequence_to_uniprot(input_text):
     sequence = "".join(line.strip() for line in lines if not line.startswith(">"))
     if not sequence:
         return None
+    try:
+        return _search_uniprot_sequence(sequence)
+    except requests.RequestException:
+        return None
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _search_uniprot_sequence(sequence):
+    # Raises on HTTP errors so failed lookups are not cached
     params = {"query": f'sequence:"{sequence}"', "format": "json", "size": 1}
-    r = requests.get(UNIPROT_SEARCH_URL, params=params)
-    if r.status_code == 200 and r.json().get("results"):
-        return r.json()["results"][0]["primaryAccession"]
-    return None
+    r = _session.get(UNIPROT_SEARCH_URL, params=params)
+    r.raise_for_status()
+    results = orjson.loads(r.content).get("results")
+    return results[0]["primaryAccession"] if results else None
 
-def get_string_interactions(uniprot_id, species=9606, min_score=0.4):
+def get_string_interactions(uniprot_ids, species=9606, min_score=0.4):
+    if isinstance(uniprot_ids, str):
+        uniprot_ids = [uniprot_ids]
+    # Round the slider value so float noise doesn't create new cache entries
+    try:
+        return _fetch_string_interactions(tuple(uniprot_ids), int(species), round(min_score, 2))
+    except requests.RequestException:
+        return None
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def _fetch_string_interactions(uniprot_ids, species, min_score):
     params = {
-        "identifiers": uniprot_id,
         "species": species,
         "caller_identity": "streamlit_app",
         "required_score": int(min_score * 1000),  # STRING API uses integer scores
         "output_format": STRING_OUTPUT_FORMAT,
         "method": STRING_METHOD,
     }
-    r = requests.get(f"{STRING_API_URL}/{STRING_OUTPUT_FORMAT}/{STRING_METHOD}", params=params)
-    if r.status_code == 200:
-        return r.json()
-    return None
+    batches = []
+    ids = iter(uniprot_ids)
+    while batch := list(islice(ids, STRING_MAX_IDENTIFIERS)):
+        batches.append("\r".join(batch))  # STRING separates identifiers with %0d
+
+    def post_batch(identifiers):
+        # Raises on HTTP errors so failed requests are not cached
+        r = _session.post(
+            f"{STRING_API_URL}/{STRING_OUTPUT_FORMAT}/{STRING_METHOD}",
+            data={**params, "identifiers": identifiers},
+        )
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
+    if len(batches) == 1:
+        return post_batch(batches[0])
+    data = []
+    for result in _fetch_pool.map(post_batch, batches):
+        data.extend(result)
+    return data
+
+def interaction_score(interaction):
+    # STRING reports either "combined_score" (0-1000) or "score" (0-1)
+    if "combined_score" in interaction:
+        return float(interaction["combined_score"]) / 1000  # Normalize score
+    return float(interaction.get("score", 0))
 
 def build_network(data):
-    G = nx.Graph()
-    for interaction in data:
-        protein1 = interaction["preferredName_A"]
-        protein2 = interaction["preferredName_B"]
-        score = float(interaction["combined_score"]) / 1000  # Normalize score
-        if score > 0:
-            G.add_edge(protein1, protein2, weight=score)
+    G = nx.Graph()  # STRING interactions are symmetric; keep edges undirected
+    edges = (
+        (interaction["preferredName_A"], interaction["preferredName_B"], interaction_score(interaction))
+        for interaction in data
+    )
+    G.add_weighted_edges_from(edge for edge in edges if edge[2] > 0)
     return G
 
-def find_hub_genes(G, top_n=10):
-    degrees = dict(G.degree())
-    hub_genes = sorted(degrees, key=degrees.get, reverse=True)[:top_n]
-    return hub_genes
+def find_hub_genes(degrees, top_n=10):
+    return [gene for gene, _ in heapq.nlargest(top_n, degrees.items(), key=itemgetter(1))]
+
+def _force_layout(G, iterations):
+    if _fa2 is not None:
+        try:
+            return _fa2.forceatlas2_networkx_layout(G, pos=None, iterations=iterations)
+        except Exception:
+            pass  # fa2 0.3.5 calls APIs removed in networkx 3.x; use spring_layout instead
+    return nx.spring_layout(G, iterations=iterations, seed=42)
 
-def create_graph_figure(G, hub_genes):
+def compute_layout(G, iterations=LAYOUT_ITERATIONS):
+    if not G:
+        return {}
+    if G.number_of_nodes() <= LARGE_NETWORK_NODES:
+        return _force_layout(G, iterations)
+
+    # Large networks: lay out the 2-core only and put the leaves on a ring around it
+    # k_core rejects self-loops, which STRING yields for A == B pairs
+    no_loops = G.copy()
+    no_loops.remove_edges_from(nx.selfloop_edges(no_loops))
+    core = nx.k_core(no_loops, k=2)
+    pos = _force_layout(core, LARGE_NETWORK_ITERATIONS) if core else {}
+    leaves = [n for n in G if n not in pos]
+    radius = 1.2 * max((max(abs(x), abs(y)) for x, y in pos.values()), default=1.0)
+    angles = np.linspace(0, 2 * np.pi, num=len(leaves), endpoint=False)
+    for node, theta in zip(leaves, angles):
+        pos[node] = (radius * np.cos(theta), radius * np.sin(theta))
+    return pos
+
+def create_graph_figure(G, hub_genes, nodes_list, pos, degrees):
     if not G.edges():
         return go.Figure(layout=go.Layout(title="No interactions found for the given parameters."))
 
-    pos = nx.spring_layout(G, seed=42)
-    degrees = dict(G.degree())
+    # Build edge coordinates as NaN-separated segments in one vectorized pass
+    pos_arr = np.array([pos[n] for n in nodes_list], dtype=np.float32)
+    idx = {n: i for i, n in enumerate(nodes_list)}
+    n_edges = G.number_of_edges()
+    src_idx = np.fromiter((idx[a] for a, _ in G.edges()), dtype=np.int32, count=n_edges)
+    dst_idx = np.fromiter((idx[b] for _, b in G.edges()), dtype=np.int32, count=n_edges)
 
-    edge_x, edge_y = [], []
-    for src, dst in G.edges():
-        x0, y0 = pos[src]
-        x1, y1 = pos[dst]
-        edge_x.extend([x0, x1, None])
-        edge_y.extend([y0, y1, None])
+    edge_x = np.empty(3 * n_edges, dtype=np.float32)
+    edge_y = np.empty(3 * n_edges, dtype=np.float32)
+    edge_x[0::3], edge_x[1::3], edge_x[2::3] = pos_arr[src_idx, 0], pos_arr[dst_idx, 0], np.nan
+    edge_y[0::3], edge_y[1::3], edge_y[2::3] = pos_arr[src_idx, 1], pos_arr[dst_idx, 1], np.nan
 
-    edge_trace = go.Scatter(
+    edge_trace = go.Scattergl(
         x=edge_x, y=edge_y,
         line=dict(width=1.5, color='gray'),
         hoverinfo='none',
         mode='lines'
     )
 
-    node_x, node_y, node_size, node_color, node_text, hover_text = [], [], [], [], [], []
-    for node in G.nodes():
-        x, y = pos[node]
-        degree = degrees[node]
-        node_x.append(x)
-        node_y.append(y)
-        node_size.append(15 + degree * 2)
-        node_color.append('red' if node in hub_genes else 'royalblue')
-        node_text.append(node)  # Just the node name
-        hover_text.append(f"{node}<br>Degree: {degree}")
-
-    node_trace = go.Scatter(
+    hub_set = set(hub_genes)
+    node_x, node_y = pos_arr[:, 0], pos_arr[:, 1]
+    degree_arr = np.fromiter((degrees[n] for n in nodes_list), dtype=np.int32, count=len(nodes_list))
+    is_hub = np.fromiter((n in hub_set for n in nodes_list), dtype=bool, count=len(nodes_list))
+    node_size = 15 + degree_arr * 2
+    node_color = np.where(is_hub, 'red', 'royalblue').tolist()
+    hover_text = [f"{node}<br>Degree: {degree}" for node, degree in zip(nodes_list, degree_arr.tolist())]
+
+    node_trace = go.Scattergl(
         x=node_x, y=node_y,
         mode='markers+text',
-        text=node_text,  # Use node_text here
+        text=nodes_list,  # Just the node names
         textposition="middle center",
         textfont=dict(color='white', size=10),
         marker=dict(size=node_size, color=node_color, line=dict(width=1, color='white')),
@@ -114,25 +247,72 @@ def create_graph_figure(G, hub_genes):
     fig = go.Figure(data=[edge_trace, node_trace], layout=layout)
     return fig
 
-def generate_summary(text, max_tokens=150):
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def render_network_png(fig_json):
+    # Takes the figure as JSON so the cache key is a plain string
+    fig = pio.from_json(fig_json)
+    buf = io.BytesIO()
+    fig.write_image(buf, format="png", engine="kaleido")
+    return buf.getvalue()
+
+@st.cache_resource
+def _summary_cache():
+    # Finished summaries keyed on a truncated hash of the prompt text, oldest first
+    return threading.Lock(), OrderedDict()
+
+def _get_cached_summary(key):
+    lock, summaries = _summary_cache()
+    with lock:
+        entry = summaries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > CACHE_TTL:
+            del summaries[key]
+            return None
+        return entry[1]
+
+def _store_summary(key, summary):
+    lock, summaries = _summary_cache()
+    with lock:
+        summaries[key] = (time.monotonic(), summary)
+        summaries.move_to_end(key)
+        while len(summaries) > SUMMARY_CACHE_ENTRIES:
+            summaries.popitem(last=False)
+
+def generate_summary(text, placeholder, max_tokens=150):
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    cached = _get_cached_summary(key)
+    if cached:
+        placeholder.info(cached)
+        return cached
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        stream = _client.chat.completions.create(
+            model="gpt-4o-mini",
             messages=[
-                {"role": "user", "content": f"Summarize: {text}"}
+                {"role": "user", "content": f"Summarize this protein network in ≤120 words: {text}"}
             ],
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            stream=True,
         )
-        return response.choices[0].message.content.strip()
+        summary = ""
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                summary += chunk.choices[0].delta.content
+                placeholder.info(summary)  # Show tokens as they arrive
     except Exception as e:
+        placeholder.empty()
         st.error(f"Error generating summary: {e}")
         return None
+    summary = summary.strip()
+    if summary:
+        _store_summary(key, summary)
+    return summary
 
 # ------------- Main App -------------------
 st.title("🧬 Prot'n'Hub")
 
 input_type = st.radio("Input Type", ["UniProt ID", "Raw Sequence"])
-user_input = st.text_area("Enter UniProt ID or Raw Sequence", height=100)
+user_input = st.text_area("Enter UniProt IDs (one protein per line) or Raw Sequence", height=100)
 
 species_dict = {
     "Human (Homo sapiens)": 9606,
@@ -145,8 +325,12 @@ species_dict = {
 selected_species = st.selectbox("Choose species", list(species_dict.keys()))
 species = st.number_input("Enter NCBI Taxonomy ID:", value=9606) if selected_species == "Custom (enter manually)" else species_dict[selected_species]
 score_threshold = st.slider("Minimum Interaction Score", 0.0, 1.0, 0.4, 0.05)
+prepare_png = st.checkbox("Prepare PNG download", value=False)
 
 if st.button("Analyze Network"):
+    # Clear the previous result so a failed run doesn't leave stale output on screen
+    st.session_state.pop("analysis", None)
+    st.session_state.pop("fig", None)
     with st.spinner("Fetching and building network..."):
         if input_type == "Raw Sequence":
             uniprot_id = map_sequence_to_uniprot(user_input.strip())
@@ -155,45 +339,82 @@ if st.button("Analyze Network"):
                 st.stop()
             else:
                 st.success(f"Mapped to UniProt ID: {uniprot_id}")
+            uniprot_ids = [uniprot_id]
         else:
-            uniprot_id = user_input.strip()
+            uniprot_ids = [line.strip() for line in user_input.strip().splitlines() if line.strip()]
 
-        data = get_string_interactions(uniprot_id, species, score_threshold)
+        data = get_string_interactions(uniprot_ids, species, score_threshold)
         if not data:
             st.error("No interaction data found.")
         else:
             G = build_network(data)
-            hub_genes = find_hub_genes(G)
-            st.subheader("🔗 Top Hub Genes")
-            st.success(", ".join(hub_genes))
+            degrees = dict(G.degree())
+            # Kept in session state so widget reruns (e.g. the PNG checkbox) don't refetch
+            st.session_state["analysis"] = {
+                "uniprot_ids": uniprot_ids,
+                "G": G,
+                "nodes_list": list(G.nodes()),
+                "degrees": degrees,
+                "hub_genes": find_hub_genes(degrees),
+                "network_json": orjson.dumps(nx.node_link_data(G)),
+                "pos_future": _layout_pool.submit(compute_layout, G),  # Layout runs in the background
+                "summary": None,
+                "summary_done": False,  # Set after the first attempt, successful or not
+            }
+
+analysis = st.session_state.get("analysis")
+if analysis:
+    G = analysis["G"]
+    nodes_list = analysis["nodes_list"]
+    degrees = analysis["degrees"]
+    hub_genes = analysis["hub_genes"]
 
-            fig = create_graph_figure(G, hub_genes)
-            st.plotly_chart(fig, use_container_width=True)
+    st.subheader("🔗 Top Hub Genes")
+    st.success(", ".join(hub_genes))
 
-            # Download button for the network (as JSON)
-            network_json = nx.node_link_data(G)
+    # Draw the chart as soon as the background layout is ready
+    fig = st.session_state.get("fig")
+    if fig is None:
+        try:
+            pos = analysis["pos_future"].result()
+            fig = create_graph_figure(G, hub_genes, nodes_list, pos, degrees)
+            st.session_state["fig"] = fig
+        except Exception as e:
+            st.error(f"Error computing network layout: {e}")
+    if fig is not None:
+        st.plotly_chart(fig, use_container_width=True)
+
+    # Download button for the network (as JSON)
+    st.download_button(
+        label="Download Network (JSON)",
+        data=analysis["network_json"],
+        file_name="protein_network.json",
+        mime="application/json",
+    )
+
+    # Download button for the network (as PNG), only rendered on request
+    if prepare_png and fig is not None:
+        try:
             st.download_button(
-                label="Download Network (JSON)",
-                data=str(network_json).encode("utf-8"),
-                file_name="protein_network.json",
-                mime="application/json",
+                label="Download Network (PNG)",
+                data=render_network_png(fig.to_json()),
+                file_name="protein_network.png",
+                mime="image/png",
             )
+        except Exception as e:
+            st.error(f"Error saving or downloading PNG: {e}")
 
-            # Download button for the network (as PNG)
-            try:
-                fig.write_image("protein_network.png")
-                with open("protein_network.png", "rb") as file:
-                    st.download_button(
-                        label="Download Network (PNG)",
-                        data=file.read(),
-                        file_name="protein_network.png",
-                        mime="image/png",
-                    )
-            except Exception as e:
-                st.error(f"Error saving or downloading PNG: {e}")
-
-            # Summarize the network (using GPT)
-            summary = generate_summary(str(network_json))
-            if summary:
-                st.subheader("📝 Network Summary")
-                st.info(summary)
+    # Summarize the network (using GPT) once the rest of the page is drawn
+    st.subheader("📝 Network Summary")
+    if not analysis["summary_done"]:
+        payload = (
+            f"Protein {', '.join(analysis['uniprot_ids'])} network has {G.number_of_nodes()} nodes "
+            f"and {G.number_of_edges()} edges. Top hubs by degree: "
+            + ", ".join(f"{gene}({degrees[gene]})" for gene in hub_genes)
+        )
+        analysis["summary"] = generate_summary(payload, st.empty())
+        analysis["summary_done"] = True
+    elif analysis["summary"]:
+        st.info(analysis["summary"])
+    else:
+        st.info("No summary available. Run the analysis again to retry.")